@@ -0,0 +1,57 @@
+"""Mesma demo do `demo_wot_llm_client.py`, mas sobrepondo a inferência do LLM com a comunicação com o servidor."""
+
+import asyncio
+from langchain_community.llms import CTransformers
+
+from recogna_ioa.web_thing_client import WebThingClient
+from recogna_ioa.agents import (
+    ThingSelectorAgent,
+    ThingActionSelectorAgent,
+)
+from recogna_ioa.pipeline import PipelinedThingOrchestrator
+
+
+async def main():
+    prompt = "Está muito escuro, gostaria que ficasse mais claro."
+
+    # Iniciar os agentes
+    llm = CTransformers(
+        model="recogna-nlp/bode-7b-alpaca-pt-br-gguf",
+        model_file="bode-7b-alpaca-q8_0.gguf",
+        model_type="llama",
+        config={
+            "temperature": 0.0,
+            "max_new_tokens": 256,
+            "repetition_penalty": 1.2,
+        },
+    )
+    orchestrator = PipelinedThingOrchestrator(
+        client=WebThingClient("http://localhost:8888"),
+        thing_selector_agent=ThingSelectorAgent(llm_model=llm),
+        thing_action_selector_agent=ThingActionSelectorAgent(llm_model=llm),
+    )
+
+    outcome = await orchestrator.run(prompt)
+    print(f"> O agente decidiu usar o Thing {outcome.selected_thing_id}")
+    if outcome.action_outcome is None:
+        print("> Thing não encontrado")
+    else:
+        print("> Código de retorno: ", outcome.action_outcome.code.name)
+        print("> Saída obtida sem processamento")
+        print("```")
+        print(outcome.action_outcome.output)
+        print("```")
+        if outcome.action_result:
+            print("A ação foi executada com sucesso. Resultado: ")
+            print(outcome.action_result)
+        else:
+            print("Falha em executar a ação")
+
+    print("=" * 8)
+    print("ETAPAS")
+    print("=" * 8)
+    print(outcome.report.summary())
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,6 +1,5 @@
 from enum import Enum
 import json
-import re
 from typing import Any
 from pydantic import BaseModel, ConfigDict
 from langchain.prompts import PromptTemplate
@@ -43,13 +42,19 @@ class ThingSelectorAgent:
         )
         self.llm_chain = self.prompt | llm_model
 
-    def run(self, input_text: str, thing_description_list: list[dict[str, any]]) -> str:
-        """Returns the relevant device ID"""
+    def build_inputs(
+        self, input_text: str, thing_description_list: list[dict[str, any]]
+    ) -> dict[str, str]:
+        """Returns the prompt variables for the provided input and things"""
         thing_description_str = make_id_description_pair_lines(thing_description_list)
-        inputs = {
+        return {
             "input_text": input_text,
             "available_thing_ids_and_descriptions_str": thing_description_str,
         }
+
+    def run(self, input_text: str, thing_description_list: list[dict[str, any]]) -> str:
+        """Returns the relevant device ID"""
+        inputs = self.build_inputs(input_text, thing_description_list)
         response = self.llm_chain.invoke(inputs).strip()
 
         # Debug purposes only
@@ -95,6 +100,39 @@ def make_action_description_pair_lines(thing_description: dict[str, any]) -> str
     return json.dumps(thing_description["actions"])
 
 
+def extract_first_json_object(text: str) -> str | None:
+    """Returns the first balanced `{...}` block of the text.
+
+    Returns `None` while the object is not complete yet, which allows checking
+    partial outputs as they are generated.
+    """
+    start = text.find("{")
+    if start < 0:
+        return None
+    depth = 0
+    in_string = False
+    escaped = False
+    for idx in range(start, len(text)):
+        char = text[idx]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+            continue
+        if char == '"':
+            in_string = True
+        elif char == "{":
+            depth += 1
+        elif char == "}":
+            depth -= 1
+            if depth == 0:
+                return text[start : idx + 1]
+    return None
+
+
 class ThingActionSelectionAgentReturnCode(Enum):
     SUCCESS = 0
     FAILED_JSON_STRUCTURE = 1
@@ -124,43 +162,47 @@ class ThingActionSelectorAgent:
         )
         self.llm_chain = self.prompt | llm_model
 
-    def run(
+    def build_inputs(
         self,
         input_text: str,
         thing_description: dict[str, any],
         thing_state: dict[str, any],
-    ) -> ThingActionSelectionAgentOutput:
-        """Returns the relevant action ID"""
+    ) -> dict[str, str]:
+        """Returns the prompt variables for the provided input, thing and state"""
         thing_description_str = make_action_description_pair_lines(thing_description)
         thing_state_str = json.dumps(thing_state)
-        inputs = {
+        return {
             "thing_description": thing_description["description"],
             "input_text": input_text,
             "available_thing_ids_and_descriptions_str": thing_description_str,
             "thing_state": thing_state_str,
         }
-        response = "{" + self.llm_chain.invoke(inputs).strip()
-        json_match = re.search(r"\{.*?\}", response, re.DOTALL)
 
-        prompt_output = self.prompt.format(**inputs)
-        output_json = {}
-        if not json_match:
+    def parse_response(
+        self,
+        response: str,
+        thing_description: dict[str, any],
+        prompt_output: str = "",
+    ) -> ThingActionSelectionAgentOutput:
+        """Parses the raw response (including the leading `{`) into an outcome"""
+        json_str = extract_first_json_object(response)
+        if json_str is None:
             return ThingActionSelectionAgentOutput(
                 code=ThingActionSelectionAgentReturnCode.FAILED_JSON_STRUCTURE,
                 prompt=prompt_output,
                 output=response,
             )
-        if "\{\}" in response:
+        try:
+            output_json = json.loads(json_str.replace("\n", "").strip())
+        except Exception:
             return ThingActionSelectionAgentOutput(
-                code=ThingActionSelectionAgentReturnCode.FAILED_NO_ACTION_MATCHES_THE_USER_NEEDS,
+                code=ThingActionSelectionAgentReturnCode.FAILED_JSON_STRUCTURE,
                 prompt=prompt_output,
                 output=response,
             )
-        try:
-            output_json = json.loads(json_match.group(0).replace("\n", "").strip())
-        except Exception:
+        if not output_json:
             return ThingActionSelectionAgentOutput(
-                code=ThingActionSelectionAgentReturnCode.FAILED_JSON_STRUCTURE,
+                code=ThingActionSelectionAgentReturnCode.FAILED_NO_ACTION_MATCHES_THE_USER_NEEDS,
                 prompt=prompt_output,
                 output=response,
             )
@@ -170,6 +212,16 @@ class ThingActionSelectorAgent:
                 prompt=prompt_output,
                 output=response,
             )
+        # Expected shape: {"<action>": {"input": {...}}}
+        action_call = list(output_json.values())[0]
+        if not isinstance(action_call, dict) or not isinstance(
+            action_call.get("input"), dict
+        ):
+            return ThingActionSelectionAgentOutput(
+                code=ThingActionSelectionAgentReturnCode.FAILED_JSON_STRUCTURE,
+                prompt=prompt_output,
+                output=response,
+            )
 
         return ThingActionSelectionAgentOutput(
             code=ThingActionSelectionAgentReturnCode.SUCCESS,
@@ -177,3 +229,16 @@ class ThingActionSelectorAgent:
             output=response,
             parsed_output=output_json,
         )
+
+    def run(
+        self,
+        input_text: str,
+        thing_description: dict[str, any],
+        thing_state: dict[str, any],
+    ) -> ThingActionSelectionAgentOutput:
+        """Returns the relevant action ID"""
+        inputs = self.build_inputs(input_text, thing_description, thing_state)
+        response = "{" + self.llm_chain.invoke(inputs).strip()
+        return self.parse_response(
+            response, thing_description, self.prompt.format(**inputs)
+        )
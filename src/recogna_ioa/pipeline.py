@@ -0,0 +1,470 @@
+"""Pipelined orchestration of the WoT agents.
+
+The sequential flow (fetch TDs, select thing, fetch state, select action, run
+action) leaves the network idle while the LLM is generating and vice-versa.
+The orchestrator in this module overlaps these stages:
+
+* the states of the (at most `prefetch_top_k`) most likely things are
+  prefetched while the thing selector is still generating;
+* the action prompt for the likeliest thing is formatted as soon as the
+  partial selector output points to a single thing, and then given straight
+  to the LLM. The model KV cache is not reused, so only the formatting is
+  saved;
+* the action generation is stopped and submitted as soon as the first
+  complete JSON object is available.
+"""
+
+import asyncio
+import logging
+import re
+import threading
+import time
+from collections.abc import AsyncIterator
+from typing import Any
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.runnables import Runnable
+from pydantic import BaseModel
+
+from recogna_ioa.agents import (
+    ThingActionSelectionAgentOutput,
+    ThingActionSelectionAgentReturnCode,
+    ThingActionSelectorAgent,
+    ThingSelectorAgent,
+    extract_first_json_object,
+)
+from recogna_ioa.web_thing_client import WebThingClient
+
+
+class _GenerationStopped(Exception):
+    """Raised from the token callback to interrupt the LLM generation."""
+
+
+class _GenerationStoppedLogFilter(logging.Filter):
+    """Drops the warning LangChain logs when the token callback stops the generation."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return not any(
+            isinstance(arg, str) and arg.startswith(f"{_GenerationStopped.__name__}(")
+            for arg in record.args or ()
+        )
+
+
+logging.getLogger("langchain_core.callbacks.manager").addFilter(
+    _GenerationStoppedLogFilter()
+)
+
+_END_OF_STREAM = object()
+
+
+class _TokenQueueCallbackHandler(BaseCallbackHandler):
+    """Forwards the generated tokens from the LLM thread to the event loop."""
+
+    raise_error = True
+
+    def __init__(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        queue: asyncio.Queue,
+        stop_event: threading.Event,
+    ):
+        self.loop = loop
+        self.queue = queue
+        self.stop_event = stop_event
+        self.received_tokens = False
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        if self.stop_event.is_set():
+            raise _GenerationStopped()
+        self.received_tokens = True
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, token)
+
+
+class LLMTokenStream:
+    """Runs the chain in a worker thread and iterates over the tokens as generated.
+
+    The LLM runs outside of the event loop, so network I/O can progress while
+    it generates. `stop()` returns immediately and the generation is
+    interrupted at the next token; `aclose()` also waits for the worker, so
+    the model is free for the next call. LLMs which do not report tokens yield
+    the whole output at once.
+    """
+
+    def __init__(self, llm_chain: Runnable, inputs: dict[str, str] | str):
+        loop = asyncio.get_running_loop()
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.stop_event = threading.Event()
+        handler = _TokenQueueCallbackHandler(loop, self.queue, self.stop_event)
+
+        def worker() -> None:
+            try:
+                text = llm_chain.invoke(inputs, config={"callbacks": [handler]})
+                if not handler.received_tokens:
+                    loop.call_soon_threadsafe(self.queue.put_nowait, text)
+            except _GenerationStopped:
+                pass
+            except Exception as error:
+                loop.call_soon_threadsafe(self.queue.put_nowait, error)
+            finally:
+                loop.call_soon_threadsafe(self.queue.put_nowait, _END_OF_STREAM)
+
+        self.worker_future = loop.run_in_executor(None, worker)
+
+    def __aiter__(self) -> "LLMTokenStream":
+        return self
+
+    async def __anext__(self) -> str:
+        if self.stop_event.is_set():
+            raise StopAsyncIteration
+        item = await self.queue.get()
+        if item is _END_OF_STREAM:
+            self.stop_event.set()
+            raise StopAsyncIteration
+        if isinstance(item, Exception):
+            self.stop_event.set()
+            raise item
+        return item
+
+    def stop(self) -> None:
+        self.stop_event.set()
+
+    async def aclose(self) -> None:
+        self.stop()
+        await self.worker_future
+
+
+def rank_candidate_things(
+    input_text: str, thing_description_list: list[dict[str, Any]]
+) -> list[int]:
+    """Returns the thing indices sorted by word overlap with the input text.
+
+    It is only a cheap prior used before the selector produces any token; ties
+    keep the network order.
+    """
+    input_words = set(re.findall(r"\w+", input_text.lower()))
+
+    def score(idx: int) -> int:
+        thing = thing_description_list[idx]
+        thing_text = f"{thing.get('title', '')} {thing.get('description', '')}"
+        return len(input_words & set(re.findall(r"\w+", thing_text.lower())))
+
+    return sorted(range(len(thing_description_list)), key=score, reverse=True)
+
+
+def match_partial_thing_id(
+    partial_output: str, thing_description_list: list[dict[str, Any]]
+) -> list[int]:
+    """Returns the indices of the things still compatible with the partial output"""
+    partial_id = partial_output.strip()
+    return [
+        idx
+        for idx, thing in enumerate(thing_description_list)
+        if thing["id"].startswith(partial_id) or partial_id.startswith(thing["id"])
+    ]
+
+
+class StageTiming(BaseModel):
+    name: str
+    start_sec: float
+    end_sec: float
+    overlap_sec: float = 0.0
+    # Whether the back-to-back flow would also run this stage
+    sequential: bool = True
+    # Speculative state fetch of a thing which was not selected
+    wasted: bool = False
+
+    @property
+    def duration_sec(self) -> float:
+        return self.end_sec - self.start_sec
+
+
+class PipelineReport(BaseModel):
+    stages: list[StageTiming] = []
+    wall_time_sec: float = 0.0
+    prefetch_hit: bool = False
+    prewarm_hit: bool = False
+    action_stopped_early: bool = False
+
+    @property
+    def sequential_time_sec(self) -> float:
+        """Time the back-to-back flow would take to run the same stages"""
+        return sum(stage.duration_sec for stage in self.stages if stage.sequential)
+
+    @property
+    def saved_sec(self) -> float:
+        return self.sequential_time_sec - self.wall_time_sec
+
+    @property
+    def wasted_prefetch_sec(self) -> float:
+        """Time spent fetching the state of things which were not selected"""
+        return sum(stage.duration_sec for stage in self.stages if stage.wasted)
+
+    def summary(self) -> str:
+        lines = [
+            f"{stage.name}: {stage.start_sec:.2f}s -> {stage.end_sec:.2f}s "
+            f"({stage.duration_sec:.2f}s, sobreposto por {stage.overlap_sec:.2f}s)"
+            for stage in self.stages
+        ]
+        lines.append(
+            f"Tempo total: {self.wall_time_sec:.2f}s "
+            f"(sequencial: {self.sequential_time_sec:.2f}s, "
+            f"economia: {self.saved_sec:.2f}s, "
+            f"pré-carregamento descartado: {self.wasted_prefetch_sec:.2f}s)"
+        )
+        lines.append(
+            f"Estado pré-carregado: {self.prefetch_hit} | "
+            f"Prompt pré-aquecido: {self.prewarm_hit} | "
+            f"Ação submetida antecipadamente: {self.action_stopped_early}"
+        )
+        return "\n".join(lines)
+
+
+def _compute_overlaps(stages: list[StageTiming]) -> None:
+    """Fills the time each stage spent running concurrently with the others"""
+    for stage in stages:
+        intervals = sorted(
+            (max(stage.start_sec, other.start_sec), min(stage.end_sec, other.end_sec))
+            for other in stages
+            if other is not stage
+        )
+        overlap = 0.0
+        covered_until = stage.start_sec
+        for start, end in intervals:
+            start = max(start, covered_until)
+            if end > start:
+                overlap += end - start
+                covered_until = end
+        stage.overlap_sec = overlap
+
+
+class PipelineOutcome(BaseModel):
+    selected_thing_id: str = ""
+    selector_output: str = ""
+    action_outcome: ThingActionSelectionAgentOutput | None = None
+    action_result: dict | None = None
+    report: PipelineReport = PipelineReport()
+
+
+class PipelinedThingOrchestrator:
+    """Selects and runs an action for the user's prompt, overlapping I/O with inference."""
+
+    def __init__(
+        self,
+        client: WebThingClient,
+        thing_selector_agent: ThingSelectorAgent,
+        thing_action_selector_agent: ThingActionSelectorAgent,
+        prefetch_top_k: int = 2,
+    ):
+        self.client = client
+        self.thing_selector_agent = thing_selector_agent
+        self.thing_action_selector_agent = thing_action_selector_agent
+        self.prefetch_top_k = prefetch_top_k
+
+    async def run(self, input_text: str) -> PipelineOutcome:
+        time_origin = time.perf_counter()
+        report = PipelineReport()
+        stages = report.stages
+        outcome = PipelineOutcome(report=report)
+
+        def elapsed() -> float:
+            return time.perf_counter() - time_origin
+
+        async def timed(name: str, awaitable, sequential: bool = True):
+            start = elapsed()
+            result = await awaitable
+            stages.append(
+                StageTiming(
+                    name=name,
+                    start_sec=start,
+                    end_sec=elapsed(),
+                    sequential=sequential,
+                )
+            )
+            return result
+
+        # Stage 1: fetch the TDs (the client property is blocking)
+        thing_description_list = await timed(
+            "td_fetch", asyncio.to_thread(lambda: self.client.available_things)
+        )
+
+        state_tasks: dict[int, asyncio.Task] = {}
+        prewarm_tasks: dict[int, asyncio.Task] = {}
+        discarded_tasks: list[asyncio.Task] = []
+        prefetch_stages: list[tuple[int, StageTiming]] = []
+        streams: list[LLMTokenStream] = []
+        selected_idx = None
+
+        async def fetch_state(idx: int) -> dict | None:
+            start = elapsed()
+            try:
+                return await self.client.get_properties(index=idx)
+            finally:
+                # Cancelled fetches also occupied the network until now
+                stage = StageTiming(
+                    name=f"state_prefetch[{thing_description_list[idx]['id']}]",
+                    start_sec=start,
+                    end_sec=elapsed(),
+                    sequential=False,
+                )
+                prefetch_stages.append((idx, stage))
+                stages.append(stage)
+
+        def discard_speculative_work(keep: set[int]) -> None:
+            for tasks in (state_tasks, prewarm_tasks):
+                for idx in [idx for idx in tasks if idx not in keep]:
+                    tasks[idx].cancel()
+                    discarded_tasks.append(tasks.pop(idx))
+
+        def prefetch_states(candidates: list[int]) -> None:
+            """Keeps at most `prefetch_top_k` fetches for the likeliest candidates"""
+            discard_speculative_work(set(candidates))
+            for idx in candidates:
+                if len(state_tasks) >= self.prefetch_top_k:
+                    break
+                if idx not in state_tasks:
+                    state_tasks[idx] = asyncio.create_task(fetch_state(idx))
+
+        async def prewarm_action_prompt(idx: int) -> str:
+            thing_state = await state_tasks[idx]
+            start = elapsed()
+            inputs = self.thing_action_selector_agent.build_inputs(
+                input_text, thing_description_list[idx], thing_state
+            )
+            prompt = self.thing_action_selector_agent.prompt.format(**inputs)
+            stages.append(
+                StageTiming(
+                    name="action_prompt_prewarm",
+                    start_sec=start,
+                    end_sec=elapsed(),
+                    sequential=False,
+                )
+            )
+            return prompt
+
+        try:
+            # Stage 2: select the thing while prefetching the likeliest states
+            ranked_candidates = rank_candidate_things(
+                input_text, thing_description_list
+            )
+            prefetch_states(ranked_candidates)
+            selector_inputs = self.thing_selector_agent.build_inputs(
+                input_text, thing_description_list
+            )
+            selector_output = ""
+            start = elapsed()
+            streams.append(
+                LLMTokenStream(self.thing_selector_agent.llm_chain, selector_inputs)
+            )
+            async for token in streams[-1]:
+                selector_output += token
+                matching = set(
+                    match_partial_thing_id(selector_output, thing_description_list)
+                )
+                candidates = [idx for idx in ranked_candidates if idx in matching]
+                prefetch_states(candidates)
+                if (
+                    len(candidates) == 1
+                    and candidates[0] in state_tasks
+                    and candidates[0] not in prewarm_tasks
+                ):
+                    prewarm_tasks[candidates[0]] = asyncio.create_task(
+                        prewarm_action_prompt(candidates[0])
+                    )
+            await streams[-1].aclose()
+            stages.append(
+                StageTiming(name="thing_selection", start_sec=start, end_sec=elapsed())
+            )
+            selected_thing_id = selector_output.strip()
+            outcome.selector_output = selector_output
+            outcome.selected_thing_id = selected_thing_id
+
+            for idx, thing in enumerate(thing_description_list):
+                if thing["id"] == selected_thing_id:
+                    selected_idx = idx
+                    break
+
+            # Speculative work for things which were not selected is discarded
+            discard_speculative_work({selected_idx})
+
+            if selected_idx is None:
+                return outcome
+            target_thing_description = thing_description_list[selected_idx]
+
+            # Stage 3: reuse the prefetched state and prompt when available
+            report.prefetch_hit = selected_idx in state_tasks
+            report.prewarm_hit = selected_idx in prewarm_tasks
+            if report.prewarm_hit:
+                action_prompt = await prewarm_tasks[selected_idx]
+            else:
+                if not report.prefetch_hit:
+                    # Required fetch, outside of the speculative budget
+                    state_tasks[selected_idx] = asyncio.create_task(
+                        fetch_state(selected_idx)
+                    )
+                action_prompt = await prewarm_action_prompt(
+                    selected_idx
+                )
+
+            # Stage 4: select the action, submitting it once the JSON is complete.
+            # The prepared prompt goes straight to the LLM, skipping the template.
+            action_output = ""
+            start = elapsed()
+            streams.append(
+                LLMTokenStream(
+                    self.thing_action_selector_agent.llm_chain.last, action_prompt
+                )
+            )
+            async for token in streams[-1]:
+                action_output += token
+                if extract_first_json_object("{" + action_output) is not None:
+                    # The worker is awaited while the action runs
+                    streams[-1].stop()
+                    report.action_stopped_early = True
+                    break
+            stages.append(
+                StageTiming(
+                    name="action_selection", start_sec=start, end_sec=elapsed()
+                )
+            )
+            action_outcome = self.thing_action_selector_agent.parse_response(
+                "{" + action_output.strip(), target_thing_description, action_prompt
+            )
+            outcome.action_outcome = action_outcome
+
+            # Stage 5: run the action
+            if action_outcome.code == ThingActionSelectionAgentReturnCode.SUCCESS:
+                out_dict = action_outcome.parsed_output
+                action_id = list(out_dict.keys())[0]
+                params_dict = out_dict[action_id]["input"]
+                outcome.action_result, _ = await asyncio.gather(
+                    timed(
+                        "action_run",
+                        self.client.run_action(
+                            action_name=action_id,
+                            input_data=params_dict,
+                            index=selected_idx,
+                        ),
+                    ),
+                    streams[-1].aclose(),
+                )
+            return outcome
+        finally:
+            # Runs on every exit path, so no speculative task or LLM worker
+            # outlives the call
+            pending_tasks = [
+                *state_tasks.values(),
+                *prewarm_tasks.values(),
+                *discarded_tasks,
+            ]
+            for task in pending_tasks:
+                task.cancel()
+            await asyncio.gather(
+                *pending_tasks,
+                *(stream.aclose() for stream in streams),
+                return_exceptions=True,
+            )
+            for idx, stage in prefetch_stages:
+                stage.sequential = idx == selected_idx
+                stage.wasted = idx != selected_idx
+            report.wall_time_sec = elapsed()
+            _compute_overlaps(stages)
@@ -0,0 +1,70 @@
+from langchain_core.language_models.fake import FakeListLLM
+
+from recogna_ioa.agents import (
+    ThingActionSelectionAgentReturnCode,
+    ThingActionSelectorAgent,
+    extract_first_json_object,
+)
+
+LAMP_THING = {
+    "id": "urn:dev:ops:my-lamp-1234",
+    "description": "A web connected lamp",
+    "actions": {"fade": {"title": "Fade"}},
+}
+
+
+def test_extract_first_json_object_nested():
+    text = '{"fade": {"input": {"brightness": 80, "duration": 10}}} e mais texto {}'
+    assert (
+        extract_first_json_object(text)
+        == '{"fade": {"input": {"brightness": 80, "duration": 10}}}'
+    )
+
+
+def test_extract_first_json_object_braces_inside_strings():
+    text = 'prefixo {"a": "}{", "b": "\\"}"} sufixo'
+    assert extract_first_json_object(text) == '{"a": "}{", "b": "\\"}"}'
+
+
+def test_extract_first_json_object_incomplete():
+    assert extract_first_json_object('{"fade": {"input": {"brightness": 80}') is None
+    assert extract_first_json_object('{"a": "}') is None
+    assert extract_first_json_object("sem json") is None
+
+
+def test_action_selector_run_nested_payload():
+    llm = FakeListLLM(responses=['"fade": {"input": {"brightness": 80}}} fim'])
+    agent = ThingActionSelectorAgent(llm_model=llm)
+    outcome = agent.run("Mais claro", LAMP_THING, thing_state={"brightness": 50})
+    assert outcome.code == ThingActionSelectionAgentReturnCode.SUCCESS
+    assert outcome.parsed_output == {"fade": {"input": {"brightness": 80}}}
+
+
+def test_action_selector_empty_object_means_no_action():
+    agent = ThingActionSelectorAgent(llm_model=FakeListLLM(responses=[""]))
+    outcome = agent.parse_response("{}", LAMP_THING)
+    assert (
+        outcome.code
+        == ThingActionSelectionAgentReturnCode.FAILED_NO_ACTION_MATCHES_THE_USER_NEEDS
+    )
+
+
+def test_action_selector_parse_failures():
+    agent = ThingActionSelectorAgent(llm_model=FakeListLLM(responses=[""]))
+    assert (
+        agent.parse_response('{"fade": ', LAMP_THING).code
+        == ThingActionSelectionAgentReturnCode.FAILED_JSON_STRUCTURE
+    )
+    assert (
+        agent.parse_response('{"explode": {"input": {}}}', LAMP_THING).code
+        == ThingActionSelectionAgentReturnCode.FAILED_ACTION_DOES_NOT_EXIST
+    )
+
+
+def test_action_selector_requires_input_object():
+    agent = ThingActionSelectorAgent(llm_model=FakeListLLM(responses=[""]))
+    for response in ['{"fade": {}}', '{"fade": 1}', '{"fade": {"input": 5}}']:
+        assert (
+            agent.parse_response(response, LAMP_THING).code
+            == ThingActionSelectionAgentReturnCode.FAILED_JSON_STRUCTURE
+        )
@@ -0,0 +1,260 @@
+import asyncio
+import logging
+import time
+from typing import Any
+
+import pytest
+from langchain_core.language_models.llms import LLM
+
+from recogna_ioa.agents import (
+    ThingActionSelectionAgentReturnCode,
+    ThingActionSelectorAgent,
+    ThingSelectorAgent,
+)
+from recogna_ioa.pipeline import (
+    PipelinedThingOrchestrator,
+    StageTiming,
+    _compute_overlaps,
+    match_partial_thing_id,
+    rank_candidate_things,
+)
+
+THINGS = [
+    {
+        "id": "urn:dev:ops:my-lamp-1234",
+        "title": "My Lamp",
+        "description": "A web connected lamp",
+        "actions": {"fade": {"title": "Fade"}},
+    },
+    {
+        "id": "urn:dev:ops:my-humidity-sensor-1234",
+        "title": "My Humidity Sensor",
+        "description": "A web connected humidity sensor",
+        "actions": {},
+    },
+    {
+        "id": "urn:dev:ops:my-fan-1234",
+        "title": "My Fan",
+        "description": "A web connected fan",
+        "actions": {"spin": {"title": "Spin"}},
+    },
+]
+
+LAMP_ACTION_TOKENS = [
+    '"fade": ',
+    '{"input": {"brightness": 80, "duration": 10}}',
+    "}",
+    " extra",
+    " more",
+]
+
+
+class FakeStreamingLLM(LLM):
+    """Reports one token at a time through the callbacks, like `CTransformers`."""
+
+    token_lists: list[list[Any]]
+    token_delay_sec: float = 0.05
+    generated: list[str] = []
+    prompts: list[str] = []
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-streaming"
+
+    def _call(self, prompt, stop=None, run_manager=None, **kwargs) -> str:
+        self.prompts.append(prompt)
+        text = ""
+        for token in self.token_lists.pop(0):
+            time.sleep(self.token_delay_sec)
+            if isinstance(token, Exception):
+                raise token
+            self.generated.append(token)
+            text += token
+            if run_manager:
+                run_manager.on_llm_new_token(token)
+        return text
+
+
+class FakeWebThingClient:
+    def __init__(self, fetch_delay_sec: float = 0.2):
+        self.fetch_delay_sec = fetch_delay_sec
+        self.fetched_indices: list[int] = []
+        self.actions: list[tuple[str, dict, int]] = []
+        self.generated_at_action: list[str] | None = None
+        self.llm: FakeStreamingLLM | None = None
+
+    @property
+    def available_things(self) -> list[dict[str, Any]]:
+        return THINGS
+
+    async def get_properties(self, index=None, thing_id=None) -> dict:
+        await asyncio.sleep(self.fetch_delay_sec)
+        self.fetched_indices.append(index)
+        return {"brightness": 50}
+
+    async def run_action(self, action_name, input_data, index=None, thing_id=None):
+        self.generated_at_action = list(self.llm.generated)
+        self.actions.append((action_name, input_data, index))
+        return {"status": "created"}
+
+
+def make_orchestrator(token_lists, prefetch_top_k=2, fetch_delay_sec=0.2):
+    llm = FakeStreamingLLM(token_lists=token_lists)
+    client = FakeWebThingClient(fetch_delay_sec=fetch_delay_sec)
+    client.llm = llm
+    orchestrator = PipelinedThingOrchestrator(
+        client=client,
+        thing_selector_agent=ThingSelectorAgent(llm_model=llm),
+        thing_action_selector_agent=ThingActionSelectorAgent(llm_model=llm),
+        prefetch_top_k=prefetch_top_k,
+    )
+    return orchestrator, client, llm
+
+
+def test_rank_candidate_things():
+    assert rank_candidate_things("turn on the fan", THINGS)[0] == 2
+    assert rank_candidate_things("nada em comum", THINGS) == [0, 1, 2]
+
+
+def test_match_partial_thing_id():
+    assert match_partial_thing_id("", THINGS) == [0, 1, 2]
+    assert match_partial_thing_id(" urn:dev:ops:my-", THINGS) == [0, 1, 2]
+    assert match_partial_thing_id("urn:dev:ops:my-f", THINGS) == [2]
+    assert match_partial_thing_id("urn:dev:ops:my-lamp-1234\n", THINGS) == [0]
+    assert match_partial_thing_id("other", THINGS) == []
+
+
+def test_compute_overlaps_uses_interval_union():
+    stages = [
+        StageTiming(name="a", start_sec=0.0, end_sec=4.0),
+        StageTiming(name="b", start_sec=1.0, end_sec=2.0),
+        StageTiming(name="c", start_sec=1.5, end_sec=3.0),
+        StageTiming(name="d", start_sec=5.0, end_sec=6.0),
+    ]
+    _compute_overlaps(stages)
+    assert [stage.overlap_sec for stage in stages] == pytest.approx(
+        [2.0, 1.0, 1.5, 0.0]
+    )
+
+
+def test_run_prefetch_hit_and_early_stop(caplog):
+    selector_tokens = ["urn:dev:ops:my-", "lamp", "-1234", "\n", "\n", "\n", "\n"]
+    orchestrator, client, llm = make_orchestrator(
+        [selector_tokens, list(LAMP_ACTION_TOKENS)]
+    )
+
+    with caplog.at_level(logging.WARNING):
+        outcome = asyncio.run(orchestrator.run("A lamp mais clara"))
+
+    report = outcome.report
+    assert outcome.selected_thing_id == "urn:dev:ops:my-lamp-1234"
+    assert outcome.action_outcome.code == ThingActionSelectionAgentReturnCode.SUCCESS
+    assert client.actions == [
+        ("fade", {"brightness": 80, "duration": 10}, 0)
+    ]
+    assert report.prefetch_hit and report.prewarm_hit
+
+    # The action is submitted before any token past the JSON is generated
+    assert report.action_stopped_early
+    assert " extra" not in client.generated_at_action
+    assert " more" not in llm.generated
+    assert "_GenerationStopped" not in caplog.text
+
+    # The selected state fetch was hidden behind the selector generation
+    sequential_names = {stage.name for stage in report.stages if stage.sequential}
+    assert sequential_names == {
+        "td_fetch",
+        "thing_selection",
+        "state_prefetch[urn:dev:ops:my-lamp-1234]",
+        "action_selection",
+        "action_run",
+    }
+    assert report.saved_sec == pytest.approx(client.fetch_delay_sec, abs=0.08)
+    # The sensor fetch is cancelled once the output no longer matches it
+    assert 0 < report.wasted_prefetch_sec < client.fetch_delay_sec
+    assert client.fetched_indices == [0]
+
+    # The prepared action prompt is given to the LLM as is
+    assert llm.prompts[-1] == outcome.action_outcome.prompt
+
+
+def test_run_prefetch_miss_is_reported_as_wasted():
+    # The prior only prefetches the lamp, but the selector picks the fan
+    selector_tokens = ["urn:dev:ops:my-", "fan-1234"]
+    action_tokens = ['"spin": {"input": {}}}']
+    orchestrator, client, _ = make_orchestrator(
+        [selector_tokens, action_tokens], prefetch_top_k=1
+    )
+
+    outcome = asyncio.run(orchestrator.run("A lamp mais clara"))
+
+    report = outcome.report
+    assert client.actions == [("spin", {}, 2)]
+    wasted = [stage.name for stage in report.stages if stage.wasted]
+    assert wasted == ["state_prefetch[urn:dev:ops:my-lamp-1234]"]
+    assert report.wasted_prefetch_sec > 0
+    # The fan state is only requested once the selector output points to it
+    assert report.saved_sec < client.fetch_delay_sec
+
+
+def test_run_selector_error_cleans_up_speculative_work():
+    selector_tokens = ["urn:dev:ops:my-", RuntimeError("LLM falhou")]
+    orchestrator, client, _ = make_orchestrator(
+        [selector_tokens], fetch_delay_sec=1.0
+    )
+
+    async def run_and_list_pending_tasks():
+        with pytest.raises(RuntimeError, match="LLM falhou"):
+            await orchestrator.run("A lamp mais clara")
+        return [
+            task for task in asyncio.all_tasks() if task is not asyncio.current_task()
+        ]
+
+    assert asyncio.run(run_and_list_pending_tasks()) == []
+    assert client.fetched_indices == []
+    assert client.actions == []
+
+
+def test_run_speculative_budget_is_shared_across_the_run():
+    selector_tokens = ["urn:dev:ops:my-", "fan", "-1234"]
+    action_tokens = ['"spin": {"input": {}}}']
+    orchestrator, client, _ = make_orchestrator(
+        [selector_tokens, action_tokens], prefetch_top_k=1
+    )
+
+    outcome = asyncio.run(orchestrator.run("turn on the fan"))
+
+    assert outcome.report.prefetch_hit
+    assert client.fetched_indices == [2]
+    assert [stage.name for stage in outcome.report.stages if stage.wasted] == []
+
+
+def test_run_without_prefetch():
+    selector_tokens = ["urn:dev:ops:my-", "fan-1234"]
+    action_tokens = ['"spin": {"input": {}}}']
+    orchestrator, client, _ = make_orchestrator(
+        [selector_tokens, action_tokens], prefetch_top_k=0
+    )
+
+    outcome = asyncio.run(orchestrator.run("turn on the fan"))
+
+    report = outcome.report
+    assert not report.prefetch_hit and not report.prewarm_hit
+    assert client.fetched_indices == [2]
+    assert client.actions == [("spin", {}, 2)]
+    assert report.wasted_prefetch_sec == 0
+
+
+def test_run_does_not_submit_action_without_input():
+    selector_tokens = ["urn:dev:ops:my-lamp-1234"]
+    action_tokens = ['"fade": {}}', " extra"]
+    orchestrator, client, _ = make_orchestrator([selector_tokens, action_tokens])
+
+    outcome = asyncio.run(orchestrator.run("A lamp mais clara"))
+
+    assert (
+        outcome.action_outcome.code
+        == ThingActionSelectionAgentReturnCode.FAILED_JSON_STRUCTURE
+    )
+    assert outcome.action_result is None
+    assert client.actions == []